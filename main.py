@@ -1,20 +1,33 @@
-import io
-import json
+import functools
 import multiprocessing
-from concurrent.futures import ProcessPoolExecutor
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
 
-import imageio
+import imageio_ffmpeg
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+import numba
+import numpy as np
+import orjson
 import requests
 import tzfpy
 from geopy import Nominatim
+from geopy.adapters import RequestsAdapter
+from PIL import Image, ImageDraw, ImageFont
 from pytz import timezone, utc
+from requests.adapters import HTTPAdapter
 from skyfield.api import Star, load, Loader, wgs84
 from skyfield.data import hipparcos
+from skyfield.functions import length_of
 from skyfield.projections import build_stereographic_projection
 
 
@@ -22,11 +35,57 @@ BASE_DIR = Path(__file__).resolve().parent
 DATA_DIR = BASE_DIR / "data"
 OUTPUT_DIR = BASE_DIR / "output"
 CACHE_FILE = BASE_DIR / "location_cache.json"
+CONSTELLATIONS_FILE = DATA_DIR / "constellations.json"
+CONSTELLATIONS_URL = 'https://raw.githubusercontent.com/Stellarium/stellarium/master/skycultures/modern_st/index.json'
 
 DEFAULT_CHART_SIZE = 12
 DEFAULT_MAX_STAR_SIZE = 100
+DEFAULT_DPI = 200
+# Faintest stars to include in the star map
+LIMITING_MAGNITUDE = 10
+# Most frames a GIF or video may have, a day at one-minute steps
+MAX_FRAMES = 1440
+# Most output files whose render parameters are remembered at once
+RENDER_MEMO_SIZE = 512
+# Most pixels a single image or frame may have, an 8000px square
+MAX_IMAGE_PIXELS = 8000 * 8000
+# Most pixels across all frames of a video, enough for a day at
+# one-minute steps with the default chart size
+MAX_SWEEP_PIXELS = 2_000_000_000
+# Pillow keeps every frame of a GIF in memory until it is written, at
+# about two bytes a pixel, so GIFs get a much smaller budget than videos
+MAX_GIF_PIXELS = 400_000_000
+# Largest star marker size accepted
+MAX_STAR_SIZE = 1000
+
+# GIF and video frames are rasterized directly rather than through matplotlib
+FRAME_DPI = 120
+BACKGROUND_RGB = np.array([4, 26, 64], dtype=np.float32)  # #041A40
+STAR_RGB = np.array([255, 255, 255], dtype=np.float32)
+# Constellation lines are 0.15pt wide at 70% opacity, much thinner than a
+# pixel, so draw them one pixel wide in the colour they blend to
+LINE_RGB = tuple(int(c) for c in BACKGROUND_RGB + (STAR_RGB - BACKGROUND_RGB) * 0.7 * min(1.0, 0.15 * FRAME_DPI / 72))
+GIF_PALETTE_SIZE = 16
+
+# Share keep-alive connections between outbound requests
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=20, pool_maxsize=50))
+SESSION.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=50))
+LOCATOR = Nominatim(
+    user_agent='star_map_locator',
+    adapter_factory=functools.partial(RequestsAdapter, pool_connections=20, pool_maxsize=50)
+)
+
+_load_lock = threading.Lock()
 
 def load_data():
+    # Concurrent first callers wait on a single load instead of each
+    # downloading and parsing the data themselves
+    with _load_lock:
+        return _load_data()
+
+@functools.lru_cache(maxsize=1)
+def _load_data():
     DATA_DIR.mkdir(parents=True, exist_ok=True)
 
     loader = Loader(str(DATA_DIR))
@@ -36,13 +95,10 @@ def load_data():
     # hipparcos dataset
     with loader.open(hipparcos.URL) as f:
         stars = hipparcos.load_dataframe(f)
-    # Load constellations data from Stellarium
-    # This is a URL to the modern constellation data in JSON format
-    url = 'https://raw.githubusercontent.com/Stellarium/stellarium/master/skycultures/modern_st/index.json'
-    response = requests.get(url)
-    response.raise_for_status()
-    data = response.json()
-    
+    # Sort by brightness so bright stars can be sliced off the front
+    stars = stars.sort_values('magnitude')
+    data = _load_constellations()
+
     # Extract constellation lines
     edges = []
     for constellation in data.get('constellations', []):
@@ -50,173 +106,562 @@ def load_data():
         for line in lines:
             for i in range(len(line) - 1):
                 edges.append((line[i], line[i + 1]))
+    # Keep the star-to-star pairs as an (n_edges, 2) array of HIP numbers
+    edges = np.array(
+        [(s1, s2) for s1, s2 in edges if isinstance(s1, int) and isinstance(s2, int)],
+        dtype=np.int64
+    ).reshape(-1, 2)
 
     return eph, stars, edges
 
-def get_coordinates(location):
-    cache = {}
+def _load_constellations():
+    # Load constellations data from Stellarium, keeping a copy on disk
+    # so later runs don't have to fetch it again
+    if CONSTELLATIONS_FILE.exists():
+        try:
+            return orjson.loads(CONSTELLATIONS_FILE.read_bytes())
+        except orjson.JSONDecodeError:
+            pass  # corrupt copy — fetch it again
+
+    response = SESSION.get(CONSTELLATIONS_URL)
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+
+    # Swap the file in whole so an interrupted or concurrent write can't
+    # leave a truncated copy behind
+    tmp_file = CONSTELLATIONS_FILE.with_suffix(f'.{os.getpid()}.tmp')
+    tmp_file.write_bytes(response.content)
+    os.replace(tmp_file, CONSTELLATIONS_FILE)
+    return data
+
+def _location_key(location):
+    # Treat names differing only in case or spacing as the same place
+    return ' '.join(location.lower().split())
+
+def _load_location_cache():
     # Check if cache file exists and load it
     if CACHE_FILE.exists():
         try:
-            cache = json.loads(CACHE_FILE.read_text())
-        except json.JSONDecodeError:
+            cache = orjson.loads(CACHE_FILE.read_bytes())
+            return {_location_key(location): coords for location, coords in cache.items()}
+        except orjson.JSONDecodeError:
             pass  # corrupt cache — just rebuild
+    return {}
+
+_location_cache = _load_location_cache()
+_location_cache_lock = threading.Lock()
+
+def get_coordinates(location):
+    key = _location_key(location)
 
     # If location is already cached, return it
-    if location in cache:
-        return tuple(cache[location])
+    with _location_cache_lock:
+        if key in _location_cache:
+            return tuple(_location_cache[key])
 
     # Use geopy to get coordinates from location name
-    locator = Nominatim(user_agent='star_map_locator')
-    loc = locator.geocode(location)
+    loc = LOCATOR.geocode(location)
     if not loc:
         raise ValueError(f"Location '{location}' not found")
     coords = (loc.latitude, loc.longitude)
 
-    # Save the coordinates to cache
-    cache[location] = coords
-    CACHE_FILE.write_text(json.dumps(cache))
+    # Save the coordinates to cache, swapping the file in whole so that
+    # other readers never see a partly written cache. Merge what is on
+    # disk first so entries saved by other processes aren't dropped.
+    with _location_cache_lock:
+        _location_cache.update(_load_location_cache())
+        _location_cache[key] = coords
+        tmp_file = CACHE_FILE.with_suffix(f'.{os.getpid()}.tmp')
+        tmp_file.write_bytes(orjson.dumps(_location_cache))
+        os.replace(tmp_file, CACHE_FILE)
     return coords
 
+@functools.lru_cache(maxsize=4096)
 def get_timezone(lat, lon):
     tz_name = tzfpy.get_tz(lat, lon)
     if not tz_name:
         raise ValueError(f"Timezone not found for coordinates: {lat}, {lon}")
     return tz_name
 
-def collect_celestial_data(location, when):
-    eph, stars, edges = load_data()
-
-    # Get coordinates for the location
-    lat, lon = get_coordinates(location)
-
-    # Get timezone for the location
-    timezone_str = get_timezone(lat, lon)
-    local = timezone(timezone_str)
-    dt = datetime.strptime(when, '%Y-%m-%d %H:%M:%S')
-    utc_dt = local.localize(dt).astimezone(utc)
+def _to_utc(local, when):
+    # Convert the local time at the location to UTC
+    return local.localize(when).astimezone(utc)
 
-    # Convert to UTC based on location's timezone
-    t = load.timescale().from_datetime(utc_dt)
+def _build_projection(eph, lat, lon, t):
     observer = wgs84.latlon(lat, lon).at(t)
     ra, dec, _ = observer.radec()
     center_object = Star(ra=ra, dec=dec)
 
     # Create a stereographic projection centered on the observer's position
     center = eph['earth'].at(t).observe(center_object)
-    projection = build_stereographic_projection(center)
+    return build_stereographic_projection(center)
+
+def _unit_vectors(positions):
+    p = positions.xyz.au
+    return (p / length_of(p)).astype(np.float32)
+
+@numba.njit(nogil=True, cache=True)
+def _stereographic_projection(center, x, y, z):
+    # The same formula as skyfield's build_stereographic_projection(), but
+    # for a unit center vector and star unit vectors that are normalized
+    # once rather than per frame, fused into one loop over stars. Kept
+    # serial and nogil: frames are already spread across the render
+    # thread pool, and numba's threading layers don't nest under it
+    x_c, y_c, z_c = center[0], center[1], center[2]
+    t0 = 1 / np.sqrt(x_c**2 + y_c**2)
+    t2 = np.sqrt(-z_c**2 + 1)
+    t3 = t0 * t2
+    t6 = t0 * z_c
+    out_x = np.empty_like(x)
+    out_y = np.empty_like(y)
+    for i in range(len(x)):
+        t1 = x[i] * x_c
+        t4 = y[i] * y_c
+        t5 = 1 / (t1 * t3 + t3 * t4 + z[i] * z_c + 1)
+        out_x[i] = t0 * t5 * (x[i] * y_c - x_c * y[i])
+        out_y[i] = -t5 * (t1 * t6 - t2 * z[i] + t4 * t6)
+    return out_x, out_y
+
+def _project(projection, star_positions):
+    # Single precision is plenty to place stars on the map, and halves
+    # the memory the per-frame coordinates take up
+    x, y = projection(star_positions)
+    return x.astype(np.float32), y.astype(np.float32)
+
+def _bright_stars(stars, limiting_magnitude):
+    count = np.searchsorted(stars['magnitude'].to_numpy(), limiting_magnitude, side='right')
+    return stars.iloc[:count].copy()
+
+def _constellation_edges(stars, edges):
+    # Create edges for constellations between stars that are on the map
+    valid_edges = edges[np.isin(edges, stars.index.to_numpy()).all(axis=1)]
+    edges_star1 = valid_edges[:, 0]
+    edges_star2 = valid_edges[:, 1]
+
+    return edges_star1, edges_star2
+
+def collect_celestial_data(location, when, limiting_magnitude=LIMITING_MAGNITUDE):
+    eph, stars, edges = load_data()
+    # Only project the stars that will be drawn
+    stars = _bright_stars(stars, limiting_magnitude)
+
+    # Get coordinates for the location
+    lat, lon = get_coordinates(location)
+
+    # Get timezone for the location
+    local = timezone(get_timezone(lat, lon))
+    t = load.timescale().from_datetime(_to_utc(local, when))
+    projection = _build_projection(eph, lat, lon, t)
 
     # Compute the x and y coordinates based on the projection
     star_positions = eph['earth'].at(t).observe(Star.from_dataframe(stars))
-    x, y = projection(star_positions)
-    stars['x'] = x
-    stars['y'] = y
+    stars['x'], stars['y'] = _project(projection, star_positions)
 
-    # Create edges for constellations
-    valid_edges = [(s1, s2) for s1, s2 in edges if s1 in stars.index and s2 in stars.index]
-    edges_star1 = [s1 for s1, s2 in valid_edges]
-    edges_star2 = [s2 for s1, s2 in valid_edges]
+    edges_star1, edges_star2 = _constellation_edges(stars, edges)
 
     return stars, edges_star1, edges_star2
 
+def collect_celestial_frames(location, times, limiting_magnitude=LIMITING_MAGNITUDE):
+    if not times:
+        return
+
+    eph, stars, _ = load_data()
+    stars = _bright_stars(stars, limiting_magnitude)
+    lat, lon = get_coordinates(location)
+    local = timezone(get_timezone(lat, lon))
+    t = load.timescale().from_datetimes([_to_utc(local, when) for when in times])
+
+    # Over a sweep of a few hours the stars barely move as seen from earth,
+    # so observe the catalogue once and only rebuild the projection per frame
+    star_positions = eph['earth'].at(t[0]).observe(Star.from_dataframe(stars))
+    x, y, z = _unit_vectors(star_positions)
+
+    # Each frame is centred on the observer's zenith, which is just the
+    # direction of their position from the centre of the earth, so the
+    # centres for all frames come from one vectorized call
+    centers = wgs84.latlon(lat, lon).at(t).xyz.au
+    centers = centers / length_of(centers)
+
+    # Project each frame only when it is asked for, so a long sweep never
+    # holds every frame's coordinates at once
+    for center in centers.T:
+        yield _stereographic_projection(center, x, y, z)
+
 def generate_star_map(location, when, chart_size=DEFAULT_CHART_SIZE, max_star_size=DEFAULT_MAX_STAR_SIZE):
     stars, edges_star1, edges_star2 = collect_celestial_data(location, when)
+    return plot_star_map(stars, edges_star1, edges_star2, location, when, chart_size, max_star_size)
 
-    # Define the number of stars and brightness of stars to include
-    limiting_magnitude = 10
-    bright_stars = (stars.magnitude <= limiting_magnitude)
-    magnitude = stars['magnitude'][bright_stars]
-    marker_size = max_star_size * 10 ** (magnitude / -2.5)
-
-    # Build the figure
-    fig, ax = plt.subplots(figsize=(chart_size, chart_size), facecolor='#041A40')
+def _build_star_map_axes(fig):
+    ax = fig.subplots()
 
     # Draw the stars
-    ax.scatter(
-        stars['x'][bright_stars], stars['y'][bright_stars],
-        s=marker_size, color='white', marker='.', linewidth=0, zorder=2
-    )
+    scatter = ax.scatter([], [], color='white', marker='.', linewidth=0, zorder=2)
     # Draw the constellation lines
-    xy1 = stars.loc[edges_star1][['x', 'y']].values
-    xy2 = stars.loc[edges_star2][['x', 'y']].values
-    for (x1, y1), (x2, y2) in zip(xy1, xy2):
-        ax.plot([x1, x2], [y1, y2], color='white', lw=0.15, alpha=0.7, zorder=3)
+    lines = LineCollection([], colors='white', linewidths=0.15, alpha=0.7, zorder=3)
+    ax.add_collection(lines)
 
     # Various settings for the plot
     ax.set_aspect('equal')
     ax.set_xlim(-1, 1)
     ax.set_ylim(-1, 1)
-    plt.axis('off')
+    ax.axis('off')
+
+    return ax, scatter, lines
+
+def _update_star_map(artists, stars, edges_star1, edges_star2, location, when, max_star_size):
+    ax, scatter, lines = artists
+
+    # Size the stars by brightness
+    magnitude = stars['magnitude'].to_numpy()
+    scatter.set_offsets(stars[['x', 'y']].to_numpy())
+    scatter.set_sizes(max_star_size * 10 ** (magnitude / -2.5))
+
+    xy1 = stars.loc[edges_star1][['x', 'y']].to_numpy()
+    xy2 = stars.loc[edges_star2][['x', 'y']].to_numpy()
+    lines.set_segments(np.stack([xy1, xy2], axis=1))
 
     # Set the title with location and time
-    when_datetime = datetime.strptime(when, '%Y-%m-%d %H:%M:%S')
-    ax.set_title(
-        f"Observation Location: {location}\nTime: {when_datetime.strftime('%Y-%m-%d %H:%M')}",
-        color='white',
-        fontsize=10
-    )
+    ax.set_title(_title(location, when), color='white', fontsize=10)
+
+def plot_star_map(stars, edges_star1, edges_star2, location, when, chart_size=DEFAULT_CHART_SIZE, max_star_size=DEFAULT_MAX_STAR_SIZE):
+    # Build the figure
+    fig = plt.figure(figsize=(chart_size, chart_size), facecolor='#041A40')
+    artists = _build_star_map_axes(fig)
+    _update_star_map(artists, stars, edges_star1, edges_star2, location, when, max_star_size)
 
     return fig
 
-def generate_star_map_image(location, when, chart_size=DEFAULT_CHART_SIZE, max_star_size=DEFAULT_MAX_STAR_SIZE):
-    # Generate the star map figure
-    fig = generate_star_map(location, when, chart_size, max_star_size)
+# Figures kept for saving images, one per chart size
+_figure_cache = {}
+_figure_cache_lock = threading.Lock()
+
+def _get_cached_figure(chart_size):
+    # Saved images reuse a figure and update its artists in place rather
+    # than building a new figure, axes and artists for every image
+    with _figure_cache_lock:
+        if chart_size not in _figure_cache:
+            fig = Figure(figsize=(chart_size, chart_size), facecolor='#041A40')
+            _figure_cache[chart_size] = (fig, _build_star_map_axes(fig), threading.Lock())
+        return _figure_cache[chart_size]
+
+def _title(location, when):
+    return f"Observation Location: {location}\nTime: {when.strftime('%Y-%m-%d %H:%M')}"
+
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _draw_stars(glow, cols, rows, radius):
+    # Accumulate an anti-aliased disc per star into the glow map. This runs
+    # without the GIL so frames rendered in other threads aren't held up
+    height, width = glow.shape
+    for i in range(len(cols)):
+        r = radius[i]
+        reach = int(np.ceil(r + 0.5))
+        # Discs smaller than a pixel contribute their area instead
+        area = np.pi * r * r
+        for dy in range(-reach, reach + 1):
+            py = rows[i] + dy
+            if py < 0 or py >= height:
+                continue
+            for dx in range(-reach, reach + 1):
+                px = cols[i] + dx
+                if px < 0 or px >= width:
+                    continue
+                coverage = min(max(r + 0.5 - np.sqrt(dx * dx + dy * dy), 0.0), 1.0)
+                glow[py, px] += min(coverage, area)
+
+_frame_canvas = threading.local()
+
+def _get_frame_canvas(side, title_height):
+    # Each thread reuses its buffers and font across frames instead of
+    # allocating them again for every frame
+    canvas = getattr(_frame_canvas, 'buffers', None)
+    if canvas is None or canvas[0].shape != (side, side):
+        glow = np.empty((side, side), dtype=np.float32)
+        frame = np.empty((title_height + side, side, 3), dtype=np.uint8)
+        frame[:title_height] = BACKGROUND_RGB
+        font = ImageFont.load_default(size=10 * FRAME_DPI / 72)
+        _frame_canvas.buffers = canvas = (glow, frame, font)
+    return canvas
+
+def _frame_dimensions(chart_size):
+    # Match the size of matplotlib's default axes, 77.5% of the figure
+    # width, with room above it for the title
+    side = int(chart_size * 0.775 * FRAME_DPI)
+    title_height = int(4 * 10 * FRAME_DPI / 72)
+    return side, title_height
+
+def rasterize_star_map(stars, edges_star1, edges_star2, location, when, chart_size=DEFAULT_CHART_SIZE, max_star_size=DEFAULT_MAX_STAR_SIZE):
+    side, title_height = _frame_dimensions(chart_size)
+    glow, frame, font = _get_frame_canvas(side, title_height)
+
+    # Map the [-1, 1] view onto pixel coordinates, with y pointing down
+    def to_pixels(x, y):
+        return (x + 1) * 0.5 * side, (1 - y) * 0.5 * side
+
+    # Draw the stars the same size as matplotlib's '.' marker, whose radius
+    # is a quarter of the square root of the scatter size in points
+    on_map = (stars['x'].abs() <= 1) & (stars['y'].abs() <= 1)
+    visible = stars[on_map]
+    marker_size = max_star_size * 10 ** (visible['magnitude'].to_numpy() / -2.5)
+    radius = 0.25 * np.sqrt(marker_size) * FRAME_DPI / 72
+    cols, rows = to_pixels(visible['x'].to_numpy(), visible['y'].to_numpy())
+    glow.fill(0)
+    _draw_stars(glow, cols.astype(np.int32), rows.astype(np.int32), radius)
+
+    np.minimum(glow, 1, out=glow)
+    frame[title_height:] = BACKGROUND_RGB + (STAR_RGB - BACKGROUND_RGB) * glow[..., None]
+
+    # Pillow copies the RGB buffer, so drawing on the image leaves it clean
+    image = Image.fromarray(frame)
+    draw = ImageDraw.Draw(image)
+
+    # Draw the constellation lines, skipping any that leave the sky entirely
+    xy1 = stars.loc[edges_star1][['x', 'y']].to_numpy()
+    xy2 = stars.loc[edges_star2][['x', 'y']].to_numpy()
+    near = (np.abs(xy1) < 4).all(axis=1) & (np.abs(xy2) < 4).all(axis=1)
+    x1, y1 = to_pixels(xy1[near, 0], xy1[near, 1])
+    x2, y2 = to_pixels(xy2[near, 0], xy2[near, 1])
+    for segment in zip(x1, y1 + title_height, x2, y2 + title_height):
+        draw.line(segment, fill=LINE_RGB, width=1)
+
+    draw.multiline_text(
+        (side / 2, title_height / 2), _title(location, when),
+        fill='white', font=font, anchor='mm', align='center'
+    )
+
+    return np.asarray(image)
+
+# Parameters each output file was last rendered with by this process,
+# least recently used first, and the renders currently in progress
+_rendered = OrderedDict()
+_rendering = {}
+_rendered_lock = threading.Lock()
+
+def _render_once(path, params, render):
+    # Skip the render if this exact output has already been saved. Only
+    # one render may write a path at a time: wait on an identical render
+    # that is already running rather than starting a second one, and let
+    # a render with different parameters finish before starting ours
+    while True:
+        with _rendered_lock:
+            # Check for a render in progress first, so a caller is never
+            # handed a file that another render is halfway through writing
+            running = _rendering.get(path)
+            if running is None:
+                if _rendered.get(path) == params and path.exists():
+                    _rendered.move_to_end(path)
+                    return path
+                # The render may fail after truncating the file, so forget
+                # what it held until the new render has finished
+                _rendered.pop(path, None)
+                future = Future()
+                _rendering[path] = (params, future)
+                break
+        running_params, running_future = running
+        if running_params == params:
+            return running_future.result()
+        try:
+            running_future.result()
+        except Exception:
+            pass  # its failure is reported to its own caller
+
+    try:
+        render(path)
+        if not path.exists():
+            raise RuntimeError(f"Rendering did not produce {path}")
+        with _rendered_lock:
+            _rendered[path] = params
+            if len(_rendered) > RENDER_MEMO_SIZE:
+                _rendered.popitem(last=False)
+        future.set_result(path)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _rendered_lock:
+            del _rendering[path]
+    return path
+
+def _save_image(target, location, when, chart_size, max_star_size, dpi):
+    stars, edges_star1, edges_star2 = collect_celestial_data(location, when)
+
+    # Draw the star map on the cached figure and save it as a PNG
+    fig, artists, lock = _get_cached_figure(chart_size)
+    with lock:
+        _update_star_map(artists, stars, edges_star1, edges_star2, location, when, max_star_size)
+        fig.savefig(target, format='png', dpi=dpi, bbox_inches='tight')
+
+def generate_star_map_image(location, when, chart_size=DEFAULT_CHART_SIZE, max_star_size=DEFAULT_MAX_STAR_SIZE, dpi=DEFAULT_DPI, output=None):
+    _check_chart_params(chart_size, max_star_size)
+    _check_image_size(chart_size, dpi)
+    when_datetime = datetime.fromisoformat(when)
+
+    # Write straight into a caller's binary file object, such as an
+    # io.BytesIO, instead of saving under OUTPUT_DIR
+    if output is not None:
+        _save_image(output, location, when_datetime, chart_size, max_star_size, dpi)
+        return output
 
-    # Save the figure to a PNG file
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-    when_datetime = datetime.strptime(when, '%Y-%m-%d %H:%M:%S')
     filename = f"Image_{location}_{when_datetime.strftime('%Y%m%d_%H%M')}.png"
     output_path = OUTPUT_DIR / filename
-    fig.savefig(output_path, format='png', dpi=1200, bbox_inches='tight')
-    plt.close(fig)
-
-def _generate_frame(args):
-    location, when_str, chart_size, max_star_size = args
-    fig = generate_star_map(location, when_str, chart_size, max_star_size)
 
-    buf = io.BytesIO()
-    fig.savefig(buf, format='png', dpi=120, bbox_inches='tight')
-    buf.seek(0)
-    plt.close(fig)
-
-    return imageio.v2.imread(buf)
+    params = (location, when_datetime, chart_size, max_star_size, dpi)
+    return _render_once(
+        output_path, params,
+        lambda path: _save_image(path, location, when_datetime, chart_size, max_star_size, dpi)
+    )
 
-def generate_star_map_gif(location, when, hours, step_minutes, chart_size=DEFAULT_CHART_SIZE, max_star_size=DEFAULT_MAX_STAR_SIZE):
-    when_datetime = datetime.strptime(when, '%Y-%m-%d %H:%M:%S')
+def _generate_frame(args):
+    x, y, stars, edges_star1, edges_star2, location, when, chart_size, max_star_size = args
+    # The frames share one catalogue, so attach this frame's positions to
+    # a new frame rather than writing them into the shared one
+    stars = stars.assign(x=x, y=y)
+    return rasterize_star_map(stars, edges_star1, edges_star2, location, when, chart_size, max_star_size)
+
+def _render_frames(location, times, chart_size, max_star_size):
+    positions = collect_celestial_frames(location, times)
+
+    # The stars drawn and the constellation lines between them are the same
+    # in every frame, so work them out once for the whole sweep. Only the
+    # magnitudes are needed to draw the stars
+    _, stars, edges = load_data()
+    stars = _bright_stars(stars, LIMITING_MAGNITUDE)[['magnitude']]
+    edges_star1, edges_star2 = _constellation_edges(stars, edges)
+
+    # Frames are drawn in threads so they share the data already loaded for
+    # the projection instead of copying it into worker processes. Only a
+    # couple of frames per worker are queued at a time, so memory stays
+    # flat however long the sweep is
+    cpu_count = multiprocessing.cpu_count()
+    with ThreadPoolExecutor(max_workers=cpu_count) as executor:
+        pending = deque()
+        for (x, y), when in zip(positions, times):
+            args = (x, y, stars, edges_star1, edges_star2, location, when, chart_size, max_star_size)
+            pending.append(executor.submit(_generate_frame, args))
+            if len(pending) >= 2 * cpu_count:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def _gif_palette():
+    # Frames only contain blends of the background and white, so a ramp
+    # between the two covers every colour in them
+    levels = np.linspace(0, 1, GIF_PALETTE_SIZE)[:, None]
+    colours = BACKGROUND_RGB + (STAR_RGB - BACKGROUND_RGB) * levels
+    palette = Image.new('P', (1, 1))
+    palette.putpalette(colours.round().astype(np.uint8).ravel().tolist())
+    return palette
+
+def _check_chart_params(chart_size, max_star_size):
+    if chart_size <= 0:
+        raise ValueError(f"chart_size must be positive, got {chart_size}")
+    if not 0 < max_star_size <= MAX_STAR_SIZE:
+        raise ValueError(f"max_star_size must be between 0 and {MAX_STAR_SIZE}, got {max_star_size}")
+
+def _check_pixels(width, height, what):
+    if width < 1 or height < 1:
+        raise ValueError(f"{what} would be {width}x{height} pixels, too small to draw")
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ValueError(f"{what} would be {width}x{height} pixels, more than the limit of {MAX_IMAGE_PIXELS}")
+
+def _check_image_size(chart_size, dpi):
+    if dpi <= 0:
+        raise ValueError(f"dpi must be positive, got {dpi}")
+    side = int(chart_size * dpi)
+    _check_pixels(side, side, f"A {chart_size} inch chart at {dpi} dpi")
+
+def _check_sweep_size(chart_size, frame_count, max_pixels=MAX_SWEEP_PIXELS):
+    # Bound the frames and their size together, since a long sweep of
+    # small frames costs as much as a short sweep of large ones
+    side, title_height = _frame_dimensions(chart_size)
+    _check_pixels(side, side + title_height, f"A frame of a {chart_size} inch chart")
+    total_pixels = side * (side + title_height) * frame_count
+    if total_pixels > max_pixels:
+        raise ValueError(f"{frame_count} frames of a {chart_size} inch chart is {total_pixels} pixels, more than the limit of {max_pixels}")
+
+def _frame_times(when, hours, step_minutes):
+    if hours < 0:
+        raise ValueError(f"hours must not be negative, got {hours}")
+    if step_minutes <= 0:
+        raise ValueError(f"step_minutes must be positive, got {step_minutes}")
     total_frames = int((hours * 60) / step_minutes)
-    times = [when_datetime + timedelta(minutes=i * step_minutes) for i in range(total_frames)]
-
-    args_list = [
-        (location, t.strftime('%Y-%m-%d %H:%M:%S'), chart_size, max_star_size)
-        for t in times
+    if total_frames < 1:
+        raise ValueError(f"{hours} hours in {step_minutes} minute steps gives no frames")
+    if total_frames > MAX_FRAMES:
+        raise ValueError(f"{hours} hours in {step_minutes} minute steps is {total_frames} frames, more than the limit of {MAX_FRAMES}")
+    return [when + timedelta(minutes=i * step_minutes) for i in range(total_frames)]
+
+def _save_gif(target, location, times, step_minutes, chart_size, max_star_size):
+    # Unlike videos these don't stream: Pillow's GIF writer needs all the
+    # frames at once, which MAX_GIF_PIXELS keeps in bounds
+    palette = _gif_palette()
+    frames = [
+        Image.fromarray(frame).quantize(palette=palette, dither=Image.Dither.NONE)
+        for frame in _render_frames(location, times, chart_size, max_star_size)
     ]
+    if frames:
+        frames[0].save(
+            target, format='GIF', save_all=True, append_images=frames[1:],
+            optimize=True, duration=step_minutes * 60 / 10, loop=0
+        )
+
+def generate_star_map_gif(location, when, hours, step_minutes, chart_size=DEFAULT_CHART_SIZE, max_star_size=DEFAULT_MAX_STAR_SIZE, output=None):
+    _check_chart_params(chart_size, max_star_size)
+    when_datetime = datetime.fromisoformat(when)
+    times = _frame_times(when_datetime, hours, step_minutes)
+    _check_sweep_size(chart_size, len(times), MAX_GIF_PIXELS)
+
+    if output is not None:
+        _save_gif(output, location, times, step_minutes, chart_size, max_star_size)
+        return output
 
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
     filename = f"GIF_{location}_{when_datetime.strftime('%Y%m%d_%H%M')}.gif"
     gif_path = OUTPUT_DIR / filename
 
-    cpu_count = multiprocessing.cpu_count()
-    with imageio.get_writer(gif_path, mode='I', duration=step_minutes * 60 / 10) as writer:
-        with ProcessPoolExecutor(max_workers=cpu_count) as executor:
-            for frame in executor.map(_generate_frame, args_list):
-                writer.append_data(frame)
-
-def generate_star_map_video(location, when, hours, step_minutes, chart_size=DEFAULT_CHART_SIZE, max_star_size=DEFAULT_MAX_STAR_SIZE, fps=30, codec='libx264', bitrate='5M'):
-    when_datetime = datetime.strptime(when, '%Y-%m-%d %H:%M:%S')
-    total_frames = int((hours * 60) / step_minutes)
-    times = [when_datetime + timedelta(minutes=i * step_minutes) for i in range(total_frames)]
+    params = (location, when_datetime, hours, step_minutes, chart_size, max_star_size)
+    return _render_once(
+        gif_path, params,
+        lambda path: _save_gif(path, location, times, step_minutes, chart_size, max_star_size)
+    )
 
-    args_list = [
-        (location, t.strftime('%Y-%m-%d %H:%M:%S'), chart_size, max_star_size)
-        for t in times
-    ]
+def _save_video(path, location, times, chart_size, max_star_size, fps, codec, bitrate):
+    # Pipe the raw RGB frames straight into ffmpeg as they are rendered
+    writer = None
+    try:
+        for frame in _render_frames(location, times, chart_size, max_star_size):
+            if writer is None:
+                height, width = frame.shape[:2]
+                writer = imageio_ffmpeg.write_frames(str(path), (width, height), fps=fps, codec=codec, bitrate=bitrate)
+                writer.send(None)  # Start ffmpeg
+            writer.send(np.ascontiguousarray(frame))
+    finally:
+        if writer is not None:
+            writer.close()
+
+def generate_star_map_video(location, when, hours, step_minutes, chart_size=DEFAULT_CHART_SIZE, max_star_size=DEFAULT_MAX_STAR_SIZE, fps=30, codec='libx264', bitrate='5M', output=None):
+    if fps <= 0:
+        raise ValueError(f"fps must be positive, got {fps}")
+    _check_chart_params(chart_size, max_star_size)
+    when_datetime = datetime.fromisoformat(when)
+    times = _frame_times(when_datetime, hours, step_minutes)
+    _check_sweep_size(chart_size, len(times))
+
+    if output is not None:
+        # ffmpeg has to write the MP4 to a real file, so copy it over after
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = Path(tmp_dir) / 'video.mp4'
+            _save_video(tmp_path, location, times, chart_size, max_star_size, fps, codec, bitrate)
+            with tmp_path.open('rb') as f:
+                shutil.copyfileobj(f, output)
+        return output
 
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
     filename = f"Video_{location}_{when_datetime.strftime('%Y%m%d_%H%M')}.mp4"
     video_path = OUTPUT_DIR / filename
 
-    cpu_count = multiprocessing.cpu_count()
-    with imageio.get_writer(video_path, fps=fps, codec=codec, bitrate=bitrate, format='FFMPEG') as writer:
-        with ProcessPoolExecutor(max_workers=cpu_count) as executor:
-            for frame in executor.map(_generate_frame, args_list):
-                writer.append_data(frame)
\ No newline at end of file
+    params = (location, when_datetime, hours, step_minutes, chart_size, max_star_size, fps, codec, bitrate)
+    return _render_once(
+        video_path, params,
+        lambda path: _save_video(path, location, times, chart_size, max_star_size, fps, codec, bitrate)
+    )